@@ -2,10 +2,25 @@ import unittest
 from pathlib import Path
 from Bio import Phylo
 import pandas as pd
+import numpy as np
 import filecmp
 
 from treealign.clonealign_visualization import CloneAlignVis
 
+
+def make_vis(genes, cnv_matrix=None, expr_matrix=None, total_gene_count=2000, cnv_meta=None):
+    """
+    Build a CloneAlignVis holding only gene-level data, skipping the tree and meta set up in __init__
+    """
+    clonealign_vis = CloneAlignVis.__new__(CloneAlignVis)
+    clonealign_vis.genes = genes
+    clonealign_vis.cnv = cnv_matrix
+    clonealign_vis.cnv_matrix = cnv_matrix
+    clonealign_vis.cnv_meta = cnv_meta
+    clonealign_vis.expr_matrix = expr_matrix
+    clonealign_vis.total_gene_count = total_gene_count
+    return clonealign_vis
+
 class TestOutputJson(unittest.TestCase):
     DATA_DIR = Path(__file__).parent / 'data'
     def test_output_json_consistency(self):
@@ -46,5 +61,120 @@ class TestOutputJson(unittest.TestCase):
 
         self.assertTrue(filecmp.cmp(self.DATA_DIR / 'test.json', self.DATA_DIR / 'OV_022_integrated.json'))
 
+class TestSubsampleGenes(unittest.TestCase):
+    def make_gene_vis(self, gene_count, total_gene_count):
+        genes = pd.DataFrame({'gene': ['gene_' + str(i) for i in range(gene_count)], 'chr': '1', 'start': range(gene_count)})
+        return make_vis(genes,
+                        cnv_matrix=pd.DataFrame({'cell_0': range(gene_count)}, index=genes['gene']),
+                        expr_matrix=pd.DataFrame({'cell_1': range(gene_count)}, index=genes['gene']),
+                        total_gene_count=total_gene_count)
+
+    def test_subsample_genes_keeps_all_genes_when_too_few(self):
+        """
+        Test all genes are kept when there are fewer than 2 * total_gene_count genes
+        """
+        for gene_count in [5, 15]:
+            clonealign_vis = self.make_gene_vis(gene_count, 10)
+            clonealign_vis.subsample_genes()
+            self.assertEqual(clonealign_vis.genes.shape[0], gene_count)
+            self.assertEqual(clonealign_vis.cnv_matrix.shape[0], gene_count)
+            self.assertEqual(clonealign_vis.expr_matrix.shape[0], gene_count)
+
+    def test_subsample_genes_takes_every_nth_gene(self):
+        """
+        Test every gene_group-th gene starting from the second one is kept
+        """
+        clonealign_vis = self.make_gene_vis(35, 10)
+        clonealign_vis.subsample_genes()
+        expected_genes = ['gene_' + str(i) for i in range(1, 35, 3)]
+        self.assertEqual(clonealign_vis.genes['gene'].tolist(), expected_genes)
+        self.assertEqual(clonealign_vis.cnv_matrix.index.tolist(), expected_genes)
+        self.assertEqual(clonealign_vis.expr_matrix.index.tolist(), expected_genes)
+
+class TestConvertCellGeneMatrix(unittest.TestCase):
+    def convert(self, chrs):
+        # one cell whose values are the gene positions
+        matrix = pd.DataFrame({'cell_0': range(len(chrs))})
+        clonealign_vis = make_vis(pd.DataFrame({'chr': chrs}), cnv_matrix=matrix)
+        return clonealign_vis.convert_cell_gene_matrix_to_list(matrix)
+
+    def test_contiguous_chromosomes(self):
+        """
+        Test genes sorted by chromosome are split into per-chromosome blocks
+        """
+        output = self.convert(['1', '1', '2', 'X', 'X'])
+        self.assertEqual(output, [{'chr': '1', 'value': [[0, 1]]},
+                                  {'chr': '2', 'value': [[2]]},
+                                  {'chr': 'X', 'value': [[3, 4]]}])
+
+    def test_non_contiguous_chromosomes(self):
+        """
+        Test each block only holds genes of its own chromosome when chromosomes are interleaved
+        """
+        output = self.convert(['1', '2', '1', 'X', '2'])
+        self.assertEqual(output, [{'chr': '1', 'value': [[0, 2]]},
+                                  {'chr': '2', 'value': [[1, 4]]},
+                                  {'chr': 'X', 'value': [[3]]}])
+
+class TestOrderChromosome(unittest.TestCase):
+    def order_genes(self, chrs):
+        genes = pd.DataFrame({'gene': ['gene_' + str(i) for i in range(len(chrs))], 'chr': chrs,
+                              'start': [(i * 7) % len(chrs) for i in range(len(chrs))]})
+        clonealign_vis = make_vis(genes, cnv_matrix=pd.DataFrame({'cell_0': range(len(chrs))}, index=genes['gene']))
+        clonealign_vis.genes = clonealign_vis.get_consensus_genes()
+        clonealign_vis.cnv_matrix = clonealign_vis.cnv_matrix.reindex(clonealign_vis.genes['gene'].to_numpy())
+        return genes, clonealign_vis
+
+    def check_blocks(self, chrs, expected_order):
+        genes, clonealign_vis = self.order_genes(chrs)
+        output = clonealign_vis.convert_cell_gene_matrix_to_list(clonealign_vis.cnv_matrix)
+        self.assertEqual([entry['chr'] for entry in output], expected_order)
+        for entry in output:
+            # every block holds exactly the genes of its chromosome, ordered by start
+            chr_genes = genes[genes['chr'] == entry['chr']].sort_values('start')
+            self.assertEqual(entry['value'][0], [int(g.split('_')[1]) for g in chr_genes['gene']])
+
+    def test_known_chromosomes(self):
+        """
+        Test known chromosomes are ordered numerically, then X and Y
+        """
+        self.check_blocks(['X', '10', '2', '1', 'Y', '2', '10', '1', 'X'], ['1', '2', '10', 'X', 'Y'])
+
+    def test_prefixed_chromosomes(self):
+        """
+        Test chromosomes not in CHR_DICT stay in separate contiguous blocks
+        """
+        self.check_blocks(['chrX', 'chr10', 'chr2', 'chr1', 'chr2', 'chr10', 'chr1', 'chrX'],
+                          ['chr1', 'chr10', 'chr2', 'chrX'])
+
+    def test_unknown_chromosomes(self):
+        """
+        Test unknown contigs are placed after known chromosomes, each in its own block
+        """
+        self.check_blocks(['MT', '1', 'GL1', 'X', '10', '2', 'MT', 'GL1', '1', '2'],
+                          ['1', '2', '10', 'X', 'GL1', 'MT'])
+
+class TestComputeCloneSpecificCnv(unittest.TestCase):
+    def test_clone_mode(self):
+        """
+        Test per-clone mode ignores NaN, takes the smallest state on ties and skips cells missing from cnv_meta
+        """
+        cnv_matrix = pd.DataFrame({'cell_0': [2, 1, np.nan, 3],
+                                   'cell_1': [2, 3, np.nan, 1],
+                                   'cell_2': [4, 3, np.nan, np.nan],
+                                   'cell_3': [1, 1, 5, 2],
+                                   'cell_4': [1, 2, np.nan, 2],
+                                   'cell_5': [6, 6, 6, 6]},
+                                  index=['gene_0', 'gene_1', 'gene_2', 'gene_3'])
+        cnv_meta = pd.DataFrame({'cell_id': ['cell_3', 'cell_0', 'cell_1', 'cell_4', 'cell_2'],
+                                 'clone_id': ['B', 'A', 'A', 'B', 'A']})
+        clonealign_vis = make_vis(None, cnv_matrix=cnv_matrix, cnv_meta=cnv_meta)
+
+        clone_cnv = clonealign_vis.compute_clone_specific_cnv('clone_id')
+
+        expected = pd.DataFrame({'B': [1, 1, 5, 2], 'A': [2, 3, np.nan, 1]},
+                                index=['gene_0', 'gene_1', 'gene_2', 'gene_3'], dtype=float)
+        pd.testing.assert_frame_equal(clone_cnv, expected, check_column_type=False)
+
 if __name__ == '__main__':
     unittest.main()        
\ No newline at end of file
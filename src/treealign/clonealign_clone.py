@@ -64,10 +64,11 @@ class CloneAlignClone(CloneAlign):
         if self.snv_df is not None:
             expr_cells = self.snv_df.columns.values
         clones = self.clone_df["clone_id"].drop_duplicates().values
+        # group cells by clone once instead of scanning clone_df for every clone
+        clone_cells = {clone: cells.values for clone, cells in self.clone_df.groupby("clone_id", sort=False)["cell_id"]}
         
         for clone in clones:
-            terminal = self.clone_df.loc[self.clone_df["clone_id"] == clone, "cell_id"].values
-            terminals.append(terminal)
+            terminals.append(clone_cells[clone])
         
         # construct total copy number input
         expr_input, clone_cnv_df = self.construct_total_copy_number_input(terminals, expr_cells)
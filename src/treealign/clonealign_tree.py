@@ -51,6 +51,8 @@ class CloneAlignTree(CloneAlign):
         self.count = 0
         # add name for nodes if the nodes don't have name
         self.add_tree_node_name(self.tree.clade)
+        # terminal names of clades visited by the recursion, filled on first lookup
+        self.clade_terminals = dict()
 
         self.min_cell_count_expr = min_cell_count_expr
         self.min_cell_count_cnv = min_cell_count_cnv
@@ -64,30 +66,45 @@ class CloneAlignTree(CloneAlign):
         self.pruned_clades = set()
 
     def add_tree_node_name(self, node):
-        if node.is_terminal():
-            return
-        if node.name is None:
-            node.name = "node_" + str(self.count)
-            self.count += 1
-        for child in node.clades:
-            self.add_tree_node_name(child)
+        count = self.count
+        # pre-order walk with an explicit stack; children are pushed reversed to keep left-to-right numbering
+        stack = [node]
+        while stack:
+            current_node = stack.pop()
+            if current_node.is_terminal():
+                continue
+            if current_node.name is None:
+                current_node.name = "node_" + str(count)
+                count += 1
+            stack.extend(reversed(current_node.clades))
+        self.count = count
         return
 
-    def record_clone_assign_to_default(self, expr_cells, root_clade):
-        for i in range(len(expr_cells)):
-            self.clone_assign_dict[expr_cells[i]] = root_clade.name
+    def get_clade_terminals(self, clade):
+        '''
+        get terminal names of clade, walking the subtree only on first lookup
+        :param clade: (Bio.Phylo.BaseTree.Clade)
+        :return: terminal names under clade (list[str])
+        '''
+        if id(clade) not in self.clade_terminals:
+            self.clade_terminals[id(clade)] = [e.name for e in clade.get_terminals()]
+        return self.clade_terminals[id(clade)]
 
-    def record_clone_assign_to_dict(self, expr_cells, clone_assign, clean_clades):
+    def record_clone_assign_to_default(self, cell_positions, root_clade):
+        self.clone_assign_array[cell_positions] = root_clade.name
+
+    def record_clone_assign_to_dict(self, cell_positions, clone_assign, clean_clades):
         '''
-        record clone assignment results to self.clone_assign_dict
-        :param expr_cells: cells in expr matrix (list[str])
+        record clone assignment results to self.clone_assign_array
+        :param cell_positions: positions of cells in self.clone_assign_array (numpy.ndarray)
         :param clone_assign: clone assignments (pandas.Series)
         :param clean_clades: clean clades in the current run (list[Clade])
         :return: None
         '''
-        for i in range(len(expr_cells)):
-            if not np.isnan(clone_assign[i]):
-                self.clone_assign_dict[expr_cells[i]] = clean_clades[int(clone_assign[i])].name
+        clone_assign = np.asarray(clone_assign, dtype=float)
+        assigned = ~np.isnan(clone_assign)
+        clade_names = np.array([clade.name for clade in clean_clades], dtype=object)
+        self.clone_assign_array[cell_positions[assigned]] = clade_names[clone_assign[assigned].astype(np.int32)]
 
     def record_param_to_dict(self, param_dict, indices, params):
         '''
@@ -104,10 +121,7 @@ class CloneAlignTree(CloneAlign):
             param_dict[indices[i]].append(params[i])
     
     def check_valid_df_input(self, *argv):
-        for arg in argv:
-            if arg is None or arg.shape[0] == 0 or arg.shape[1] == 0:
-                return False
-        return True
+        return all(arg is not None and arg.size > 0 for arg in argv)
 
     
     def assign_cells_to_tree(self):
@@ -123,11 +137,16 @@ class CloneAlignTree(CloneAlign):
         else:
             cells = list(self.snv_df.columns)
 
+        # the recursion carries cell positions along with cell names and writes clone assignments by position
+        cell_positions = np.arange(len(cells))
+        self.clone_assign_array = np.empty(len(cells), dtype=object)
+
         # record default output
-        self.record_clone_assign_to_default(cells, self.tree.clade)
+        self.record_clone_assign_to_default(cell_positions, self.tree.clade)
         
-        self.assign_cells_to_clade(self.tree.clade, cells, 0)
+        self.assign_cells_to_clade(self.tree.clade, cells, 0, cell_positions)
 
+        self.clone_assign_dict.update(zip(cells, self.clone_assign_array.tolist()))
         return
       
     # make TreeAlign tree output easier for downstream analysis
@@ -152,12 +171,13 @@ class CloneAlignTree(CloneAlign):
         return cnv_clone_assign, clone_assign_tree
 
 
-    def assign_cells_to_clade(self, current_clade, expr_cells, level):
+    def assign_cells_to_clade(self, current_clade, expr_cells, level, cell_positions):
         '''
         assign cells to a clade in Phylo tree
         :param current_clade: (Bio.Phylo.BaseTree.Clade)
         :param expr_cells: cells from scRNA (list[str])
         :param level: current level of the clade
+        :param cell_positions: positions of expr_cells in self.clone_assign_array (numpy.ndarray)
         :return: None
         '''
         print("\n\n\nStart processing ")
@@ -169,7 +189,7 @@ class CloneAlignTree(CloneAlign):
             print(f"At {current_clade.name}, the level limit exceeds.")
             return
 
-        all_terminals = current_clade.get_terminals()
+        all_terminals = self.get_clade_terminals(current_clade)
         if len(expr_cells) < self.min_cell_count_expr or len(all_terminals) < self.min_cell_count_cnv:
             self.pruned_clades.add(current_clade.name)
             if len(expr_cells) < self.min_cell_count_expr:
@@ -186,7 +206,7 @@ class CloneAlignTree(CloneAlign):
         clean_clades = []
 
         for cl in clades:
-            current_terminals = [e.name for e in cl.get_terminals()]
+            current_terminals = self.get_clade_terminals(cl)
             if len(current_terminals) < self.min_cell_count_cnv:
                 self.pruned_clades.add(cl.name)
             else:
@@ -195,10 +215,9 @@ class CloneAlignTree(CloneAlign):
 
         # if there is only one clone left, add all scRNA cells to the clade
         if len(clean_clades) == 1:
-            for cell in expr_cells:
-                self.clone_assign_dict[cell] = clean_clades[0].name
+            self.clone_assign_array[cell_positions] = clean_clades[0].name
             print(f"At {current_clade.name} there is only one clean child clade existing.")
-            self.assign_cells_to_clade(clean_clades[0], expr_cells, level + 1)
+            self.assign_cells_to_clade(clean_clades[0], expr_cells, level + 1, cell_positions)
             return
             
         # if there is no clone, return
@@ -208,7 +227,7 @@ class CloneAlignTree(CloneAlign):
             
         # print the children
         for clean_clade in clean_clades:
-            print("At " + current_clade.name + ", one of the child clade is " + clean_clade.name + " with " + str(len(clean_clade.get_terminals())) + " terminals. ")
+            print("At " + current_clade.name + ", one of the child clade is " + clean_clade.name + " with " + str(len(self.get_clade_terminals(clean_clade))) + " terminals. ")
             
             
         # construct total copy number input
@@ -295,7 +314,7 @@ class CloneAlignTree(CloneAlign):
         
         # record clone assignment results
         if 1 - none_freq >= self.min_record_freq:
-            self.record_clone_assign_to_dict(expr_cells, clone_assign, clean_clades)
+            self.record_clone_assign_to_dict(cell_positions, clone_assign, clean_clades)
             if has_total_copy_number_data and self.infer_s_score:
                 self.record_param_to_dict(self.gene_type_score_dict, clone_cnv_df.index, params_dict['mean_gene_type_score'])
             
@@ -305,9 +324,12 @@ class CloneAlignTree(CloneAlign):
         if 1 - none_freq >= self.min_record_freq and 1-none_freq >= self.min_proceed_freq:
             # proceed clone_assign
             print(f"CloneAlign Tree finishes at clade: {current_clade.name} with correct frequency {1 - none_freq}\n")
+            clone_assign_values = np.asarray(clone_assign, dtype=float)
+            expr_cells_array = np.asarray(expr_cells, dtype=object)
             for i in range(len(clean_clades)):
-                new_expr_cells = [expr_cells[k] for k in range(len(expr_cells)) if clone_assign[k] == i]
-                self.assign_cells_to_clade(clean_clades[i], new_expr_cells, level + 1)
+                clade_cells = clone_assign_values == i
+                self.assign_cells_to_clade(clean_clades[i], expr_cells_array[clade_cells].tolist(), level + 1,
+                                           cell_positions[clade_cells])
             return
         else:
             print(f"CloneAlign Tree stops at clade: {current_clade.name} with correct frequency {1 - none_freq}\n")
@@ -13,6 +13,7 @@ class CloneAlignVis:
     CHR_DICT = {'1': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, '7': 7, '8': 8,
                 '9': 9, '10': 10, '11': 11, '12': 12, '13': 13, '14': 14, '15': 15,
                 '16': 16, '17': 17, '18': 18, '19': 19, '20': 20, '21': 21, '22': 22, 'X': 23, 'Y': 24}
+    CHR_ORDER = sorted(CHR_DICT, key=CHR_DICT.get)
 
     def __init__(self, genes, tree, cnv_matrix=None, expr_matrix=None,
                  clone_assign_clone=None, clone_assign_tree=None, cnv_meta=None, expr_meta=None,
@@ -28,7 +29,9 @@ class CloneAlignVis:
         # add name for nodes if the nodes don't have name
         self.add_tree_node_name(self.tree.clade)
 
-        self.cnv = cnv_matrix.copy()
+        # full-resolution cnv used by compute_clone_specific_cnv. self.cnv_matrix is only ever
+        # replaced (reindex/iloc), never modified in place, so a reference is enough
+        self.cnv = cnv_matrix
         self.cnv_matrix = cnv_matrix
         self.expr_matrix = expr_matrix
         # rename column names
@@ -46,7 +49,8 @@ class CloneAlignVis:
 
         # if tree is not None, get cnv cell order df from tree. generate consensus data accordingly
 
-        self.cnv_cells = pd.DataFrame({'cell_id': [terminal.name for terminal in tree.get_terminals() if terminal.name in self.cnv_matrix.columns]})
+        terminal_names = pd.Index([terminal.name for terminal in tree.get_terminals()])
+        self.cnv_cells = pd.DataFrame({'cell_id': terminal_names[terminal_names.isin(self.cnv_matrix.columns)].to_numpy()})
         
         # if we have both tree and tree-based clonealign results
         if self.clone_assign_tree is not None:
@@ -69,7 +73,7 @@ class CloneAlignVis:
         self.cnv_meta = CloneAlignVis.merge_meta(self.cnv_cells, 'left', self.cnv_meta, self.cnv_clone_assign)
 
         # clean up all the expr meta data
-        self.expr_cells = pd.DataFrame({'cell_id': self.expr_matrix.columns.values.tolist()})
+        self.expr_cells = pd.DataFrame({'cell_id': self.expr_matrix.columns.to_numpy()})
         
         # remove clones not in tree
         clones = set(self.cnv_clone_assign['clonealign_tree_id'].unique().tolist())
@@ -81,22 +85,23 @@ class CloneAlignVis:
         self.expr_meta = CloneAlignVis.merge_meta(self.expr_cells, 'inner', expr_meta, self.clone_assign_tree, self.clone_assign_clone)
 
         # replace nan with empty string
-        self.cnv_meta = self.cnv_meta.replace(np.nan, "", regex=True)
-        self.expr_meta = self.expr_meta.replace(np.nan, "", regex=True)
+        self.cnv_meta = CloneAlignVis.fill_missing_meta(self.cnv_meta)
+        self.expr_meta = CloneAlignVis.fill_missing_meta(self.expr_meta)
 
         # re-order cells by EXPR_CELL_ORDER
         self.order_expr_cells(generate_sankey)
-        self.expr_cells = pd.DataFrame({'cell_id': self.expr_meta['cell_id'].values.tolist()})
+        self.expr_cells = pd.DataFrame({'cell_id': self.expr_meta['cell_id'].to_numpy()})
 
         # get consensus genes
         self.genes = self.get_consensus_genes()
         
-        self.cnv_matrix = self.cnv_matrix.reindex(self.genes['gene'].values.tolist())
-        self.expr_matrix = self.expr_matrix.reindex(self.genes['gene'].values.tolist())
+        gene_names = self.genes['gene'].to_numpy()
+        self.cnv_matrix = self.cnv_matrix.reindex(gene_names)
+        self.expr_matrix = self.expr_matrix.reindex(gene_names)
         
-        self.cnv_matrix = self.cnv_matrix.reindex(columns=self.cnv_meta['cell_id'].values.tolist())
+        self.cnv_matrix = self.cnv_matrix.reindex(columns=self.cnv_meta['cell_id'].to_numpy())
 
-        self.expr_matrix = self.expr_matrix.reindex(columns=self.expr_meta['cell_id'].values.tolist())
+        self.expr_matrix = self.expr_matrix.reindex(columns=self.expr_meta['cell_id'].to_numpy())
 
         # subsample the matrix to keep given number of genes
         self.subsample_genes()
@@ -106,17 +111,26 @@ class CloneAlignVis:
 
     # compute clone-specific copy number profiles
     def compute_clone_specific_cnv(self, clone_id_name):
-        clone_cnv_list = []
-        clones = self.cnv_meta[clone_id_name].drop_duplicates().values
-
-        for c in clones:
-            clone_cells = self.cnv_meta.loc[self.cnv_meta[clone_id_name] == c, "cell_id"].values
-            cnv_subset = self.cnv[clone_cells]
-            current_mode = cnv_subset.mode(1)[0]
-            clone_cnv_list.append(current_mode)
-
-        clone_cnv_df = pd.concat(clone_cnv_list, axis=1)
-        clone_cnv_df.columns = clones
+        # clones are kept in order of appearance, like drop_duplicates()
+        clone_codes, clones = pd.factorize(self.cnv_meta[clone_id_name])
+        cell_positions = self.cnv.columns.get_indexer(self.cnv_meta['cell_id'])
+        if (cell_positions < 0).any():
+            raise KeyError('Some cells in cnv_meta are missing from the cnv matrix.')
+        # cell-by-clone membership matrix, so the cnv matrix is used in place rather than sliced per clone
+        clone_membership = np.zeros((self.cnv.shape[1], len(clones)), dtype=np.float32)
+        np.add.at(clone_membership, (cell_positions, clone_codes), 1)
+
+        cnv_values = self.cnv.to_numpy()
+        states = pd.unique(cnv_values.ravel(order='K'))
+        states = np.sort(states[~pd.isna(states)])
+        # count cells in each copy number state per (gene, clone), one state at a time
+        counts = np.zeros((cnv_values.shape[0], len(clones), len(states)), dtype=np.float32)
+        for i, state in enumerate(states):
+            counts[:, :, i] = (cnv_values == state).astype(np.float32) @ clone_membership
+
+        # argmax takes the smallest state on ties, as DataFrame.mode does; NaN where a clone has no values
+        clone_cnv_df = pd.DataFrame(states[counts.argmax(axis=2)], index=self.cnv.index, columns=clones)
+        clone_cnv_df = clone_cnv_df.where(counts.any(axis=2))
         return clone_cnv_df
 
     def output_json(self):
@@ -124,14 +138,21 @@ class CloneAlignVis:
         if self.tree is not None:
             root = self.tree.clade
 
-            def get_json(clade):
-                js_output = {"name": clade.name, "length": clade.branch_length if clade.branch_length is not None else 1}
-                if not clade.is_terminal():
-                    clades = clade.clades
-                    js_output["children"] = []
-                    for clade in clades:
-                        js_output["children"].append(get_json(clade))
-                return js_output
+            def get_json(root):
+                # post-order walk with an explicit stack; children are built before their parent
+                node_json = dict()
+                stack = [(root, False)]
+                while stack:
+                    clade, visited = stack.pop()
+                    if visited:
+                        js_output = {"name": clade.name, "length": clade.branch_length if clade.branch_length is not None else 1}
+                        if not clade.is_terminal():
+                            js_output["children"] = [node_json.pop(id(child)) for child in clade.clades]
+                        node_json[id(clade)] = js_output
+                    else:
+                        stack.append((clade, True))
+                        stack.extend((child, False) for child in clade.clades)
+                return node_json[id(root)]
 
             json_dict = get_json(root)
             output['tree'] = json_dict
@@ -160,8 +181,9 @@ class CloneAlignVis:
 
     @staticmethod
     def pack_into_tab_data(output_json_file, data, tab_titles=None, tab_contents=None):
+        # matrices are already native python lists, so this only catches stray numpy scalars
         def convert(o):
-            if isinstance(o, np.int64):
+            if isinstance(o, np.integer):
                 return int(o)
             raise TypeError
 
@@ -169,48 +191,61 @@ class CloneAlignVis:
         for i in range(len(data)):
             tab_data = {'id': str(i), 'tabTitle': tab_titles[i], 'tabContent': tab_contents[i], 'data': data[i]}
             output.append(tab_data)
+        # stream to the file rather than building the whole json string in memory first
         with open(output_json_file, 'w') as f:
-            output_json = json.dumps(output, separators=(',', ':'), sort_keys=False, ignore_nan=True, default=convert)
-            f.write(output_json)
+            json.dump(output, f, separators=(',', ':'), sort_keys=False, ignore_nan=True, default=convert)
         return
 
     def add_tree_node_name(self, node):
-        if node.is_terminal():
-            return
-        if node.name is None:
-            node.name = "node_" + str(self.count)
-            self.count += 1
-        for child in node.clades:
-            self.add_tree_node_name(child)
+        count = self.count
+        # pre-order walk with an explicit stack; children are pushed reversed to keep left-to-right numbering
+        stack = [node]
+        while stack:
+            current_node = stack.pop()
+            if current_node.is_terminal():
+                continue
+            if current_node.name is None:
+                current_node.name = "node_" + str(count)
+                count += 1
+            stack.extend(reversed(current_node.clades))
+        self.count = count
         return
 
     def bin_expr_matrix(self, n_bins=15):
-        expr_array = self.expr_matrix.values.flatten()
+        expr_array = self.expr_matrix.to_numpy()
+        expr_median = np.median(expr_array)
        # construct bins
-        bin_width = (np.median(expr_array) - expr_array.min()) / int(n_bins / 2)
-        min_value = np.median(expr_array) - bin_width * n_bins / 2
+        bin_width = (expr_median - expr_array.min()) / int(n_bins / 2)
+        min_value = expr_median - bin_width * n_bins / 2
         bins = [min_value]
         for i in range(n_bins):
             bins.append(min_value + (i + 1) * bin_width)
 
         bins[len(bins) - 1] = expr_array.max()
-        self.expr_matrix = self.expr_matrix.apply(pd.cut, bins=bins, labels=range(n_bins))
+        # right-closed bins, same as pd.cut; bin all cells in one pass
+        bin_index = np.digitize(expr_array, bins[1:-1], right=True)
+        self.expr_matrix = pd.DataFrame(bin_index.astype(np.int8), index=self.expr_matrix.index,
+                                        columns=self.expr_matrix.columns)
         return
 
     def convert_cell_gene_matrix_to_list(self, matrix):
-        matrix = matrix.astype('int32')
-        matrix = matrix.transpose()
+        matrix = matrix.astype('int32').to_numpy().T
+        chr_codes, chrs = pd.factorize(self.genes['chr'])
         output_list = []
-        for i in list(self.genes['chr'].unique()):
-            chr_dict = {'chr': i}
-            chr_matrix = matrix.loc[:, (self.genes["chr"] == i).values]
-            chr_matrix = chr_matrix.to_numpy()
-            chr_matrix_array = []
-            for array in chr_matrix:
-                array_list = [number.item() for number in array]
-                chr_matrix_array.append(array_list)
-            chr_dict['value'] = chr_matrix_array
-            output_list.append(chr_dict)
+        # get_consensus_genes sorts genes by chromosome, so each chromosome is normally one contiguous run
+        if (chr_codes >= 0).all() and np.count_nonzero(np.diff(chr_codes)) == len(chrs) - 1:
+            chr_gene_counts = np.bincount(chr_codes, minlength=len(chrs))
+            chr_ends = np.cumsum(chr_gene_counts)
+            chr_starts = chr_ends - chr_gene_counts
+            for chr_name, start, end in zip(chrs, chr_starts, chr_ends):
+                chr_dict = {'chr': chr_name}
+                chr_dict['value'] = matrix[:, start:end].tolist()
+                output_list.append(chr_dict)
+        else:
+            for i, chr_name in enumerate(chrs):
+                chr_dict = {'chr': chr_name}
+                chr_dict['value'] = matrix[:, chr_codes == i].tolist()
+                output_list.append(chr_dict)
         return output_list
 
     @staticmethod
@@ -221,18 +256,30 @@ class CloneAlignVis:
                 output = output.merge(arg, how=how, on='cell_id')
         return output
 
+    @staticmethod
+    def fill_missing_meta(meta):
+        # only columns containing NaN become object, other columns keep their dtype
+        na_columns = meta.columns[meta.isna().any()]
+        return meta.astype(dict.fromkeys(na_columns, object)).fillna(dict.fromkeys(na_columns, ""))
+
     def subsample_genes(self):
         gene_group = int(self.genes.shape[0] / self.total_gene_count)
-        select_rows = [i for i in range(self.genes.shape[0]) if i % gene_group == 1]
-        self.genes = self.genes.iloc[select_rows]
-        self.cnv_matrix = self.cnv_matrix.iloc[select_rows]
-        self.expr_matrix = self.expr_matrix.iloc[select_rows]
+        # keep all genes if there are not enough of them to subsample
+        if gene_group <= 1:
+            return
+        self.genes = self.genes.iloc[1::gene_group].reset_index(drop=True)
+        self.cnv_matrix = self.cnv_matrix.iloc[1::gene_group]
+        self.expr_matrix = self.expr_matrix.iloc[1::gene_group]
 
     def order_chromosome(self, input_chr_series):
         if is_numeric_dtype(input_chr_series):
             return input_chr_series
         else:
-            return input_chr_series.replace(self.CHR_DICT)
+            # known chromosomes follow CHR_ORDER; other labels (e.g. 'chr1', 'MT') sort after them by name
+            chr_labels = input_chr_series.astype(str)
+            unknown_chrs = sorted(set(chr_labels.unique()).difference(self.CHR_ORDER))
+            chr_codes = pd.Categorical(chr_labels, categories=self.CHR_ORDER + unknown_chrs, ordered=True).codes
+            return pd.Series(chr_codes, index=input_chr_series.index)
 
     def get_consensus_genes(self):
         genes_list = []
@@ -253,10 +300,9 @@ class CloneAlignVis:
         order_columns = [order_column for order_column in self.expr_cell_order if
                          order_column in self.expr_meta.columns.values]
         # if the first column is also present in self.cnv_meta, match up with self.cnv_meta
-        categories = [i for i in self.cnv_meta[order_columns[0]].unique().tolist() if i is not None]
-        for category in self.expr_meta[order_columns[0]].unique().tolist():
-            if category is not None and category not in categories:
-                categories.append(category)
+        cnv_categories = pd.Index(self.cnv_meta[order_columns[0]].dropna().unique())
+        expr_categories = pd.Index(self.expr_meta[order_columns[0]].dropna().unique())
+        categories = cnv_categories.append(expr_categories.difference(cnv_categories, sort=False)).tolist()
         if generateSankey and order_columns[0] in self.cnv_meta.columns.values:
             self.cnv_meta[order_columns[0]] = pd.Categorical(self.cnv_meta[order_columns[0]], categories, ordered=True)
             self.expr_meta[order_columns[0]] = pd.Categorical(self.expr_meta[order_columns[0]], categories,
@@ -268,13 +314,14 @@ class CloneAlignVis:
         return
 
     def generate_sankey(self, select_column):
+        # row index range of every group, computed once for each meta table
+        left_ranges = self.cnv_meta.index.to_series().groupby(self.cnv_meta[select_column], observed=True).agg(['min', 'max'])
+        right_ranges = self.expr_meta.index.to_series().groupby(self.expr_meta[select_column], observed=True).agg(['min', 'max'])
         for terminal in self.terminal_nodes:
-            left_indices = self.cnv_meta.index[self.cnv_meta[select_column] == terminal].values
-            right_indices = self.expr_meta.index[self.expr_meta[select_column] == terminal].values
-            if len(left_indices) != 0 and len(right_indices) != 0:
+            if terminal in left_ranges.index and terminal in right_ranges.index:
                 sankey_element = {"name": terminal,
-                                "left": [left_indices.min().item(), left_indices.max().item()],
-                                "right": [right_indices.min().item(), right_indices.max().item()]}
+                                "left": [int(left_ranges.at[terminal, 'min']), int(left_ranges.at[terminal, 'max'])],
+                                "right": [int(right_ranges.at[terminal, 'min']), int(right_ranges.at[terminal, 'max'])]}
                 self.sankey.append(sankey_element)
 
 